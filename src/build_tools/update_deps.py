@@ -35,17 +35,39 @@ build for OSS Mozc.
 """
 
 import argparse
+import concurrent.futures
 import dataclasses
+import functools
 import hashlib
+import io
+import mmap
 import os
 import pathlib
+import shutil
+import signal
 import stat
 import subprocess
 import sys
+import threading
 import time
+from typing import Any, BinaryIO, Union
 import zipfile
 
-import requests
+import urllib3
+
+try:
+  # BLAKE3 is optional. When available, it is used to re-verify cached archives
+  # much faster than SHA-256.
+  import blake3  # pylint: disable=g-import-not-at-top
+except ImportError:
+  blake3 = None
+
+try:
+  # certifi is optional. When available, its CA bundle is used to verify TLS
+  # certificates, as requests did. Otherwise the system CA store is used.
+  import certifi  # pylint: disable=g-import-not-at-top
+except ImportError:
+  certifi = None
 
 
 ABS_SCRIPT_PATH = pathlib.Path(__file__).absolute()
@@ -54,9 +76,15 @@ ABS_MOZC_SRC_DIR = ABS_SCRIPT_PATH.parents[1]
 ABS_THIRD_PARTY_DIR = ABS_MOZC_SRC_DIR.joinpath('third_party')
 CACHE_DIR = ABS_MOZC_SRC_DIR.joinpath('third_party_cache')
 TIMEOUT = 600
+# Chunk size for network reads, file writes and hash updates.
+CHUNK_SIZE = 1 << 20
+# Buffer size to coalesce writes of downloaded archives.
+WRITE_BUFFER_SIZE = 1 << 22
+# Zip entries up to this size are extracted in memory at once.
+MAX_IN_MEMORY_EXTRACT_SIZE = 16 << 20
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(frozen=True)
 class ArchiveInfo:
   """Third party archive file to be used to build Mozc binaries.
 
@@ -64,15 +92,21 @@ class ArchiveInfo:
     url: URL of the archive.
     size: File size of the archive.
     sha256: SHA-256 of the archive.
+    filename: The filename of the archive.
+    cache_path: The path of the archive in the cache directory.
   """
   url: str
   size: int
   sha256: str
+  filename: str = dataclasses.field(init=False)
+  cache_path: pathlib.Path = dataclasses.field(
+      init=False, repr=False, compare=False
+  )
 
-  @property
-  def filename(self) -> str:
-    """The filename of the archive."""
-    return self.url.split('/')[-1]
+  def __post_init__(self):
+    filename = self.url.split('/')[-1]
+    object.__setattr__(self, 'filename', filename)
+    object.__setattr__(self, 'cache_path', CACHE_DIR.joinpath(filename))
 
   def __hash__(self):
     return hash(self.sha256)
@@ -97,86 +131,428 @@ NINJA_WIN = ArchiveInfo(
 )
 
 
-def get_sha256(path: pathlib.Path) -> str:
-  """Returns SHA-256 hash digest of the specified file.
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_pool() -> urllib3.PoolManager:
+  """Returns the connection pool shared by downloads."""
+  global _POOL
+  with _POOL_LOCK:
+    if _POOL is None:
+      kwargs = {}
+      if certifi is not None:
+        kwargs['cert_reqs'] = 'CERT_REQUIRED'
+        kwargs['ca_certs'] = certifi.where()
+      _POOL = urllib3.PoolManager(
+          num_pools=4,
+          maxsize=4,
+          # Count redirects separately from errors so that mirror redirects are
+          # followed as many times as requests did.
+          retries=urllib3.Retry(
+              total=None,
+              connect=3,
+              read=3,
+              other=3,
+              redirect=30,
+              backoff_factor=0.5,
+          ),
+          **kwargs,
+      )
+    return _POOL
+
+
+class ArchiveHasher:
+  """Calculates SHA-256 and, if available, BLAKE3 digests in a single pass."""
+
+  def __init__(self):
+    self.sha256_hasher = hashlib.sha256()
+    self.blake3_hasher = None
+    if blake3 is not None:
+      self.blake3_hasher = blake3.blake3(max_threads=blake3.blake3.AUTO)
+
+  def update(self, data) -> None:
+    self.sha256_hasher.update(data)
+    if self.blake3_hasher is not None:
+      self.blake3_hasher.update(data)
+
+  def sha256_hexdigest(self) -> str:
+    """Returns SHA-256 hash digest of the data."""
+    return self.sha256_hasher.hexdigest()
+
+  def blake3_hexdigest(self) -> Union[str, None]:
+    """Returns BLAKE3 hash digest of the data, or None if unavailable."""
+    if self.blake3_hasher is None:
+      return None
+    return self.blake3_hasher.hexdigest()
+
+
+def open_for_hashing(path: pathlib.Path) -> BinaryIO:
+  """Opens the specified file to be read sequentially for hashing.
+
+  Args:
+    path: Local path of the file to be opened.
+  Returns:
+    The opened binary file.
+  """
+  f = open(path, 'rb')
+  if hasattr(os, 'posix_fadvise'):
+    # Let the kernel read ahead more aggressively. The pages are kept in the
+    # page cache, as the archives are extracted right after verification by
+    # extract_ninja() and build_qt.py.
+    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+  return f
+
+
+def hash_file(path: pathlib.Path, hasher: Any) -> int:
+  """Updates the hasher with the content of the specified file.
+
+  The file is mapped with mmap so that the whole file is not copied into
+  memory.
+
+  Args:
+    path: Local path of the file to be hashed.
+    hasher: Hash object to be updated, e.g. ArchiveHasher.
+  Returns:
+    The size of the hashed file.
+  """
+  with open_for_hashing(path) as f:
+    size = os.fstat(f.fileno()).st_size
+    if size > 0:
+      with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        hasher.update(mm)
+  return size
+
+
+def get_digests(path: pathlib.Path) -> tuple[str, Union[str, None]]:
+  """Returns SHA-256 and BLAKE3 hash digests of the specified file.
 
   Args:
-    path: Local path the file to calculate SHA-256 about.
+    path: Local path the file to calculate hash digests about.
   Returns:
-    SHA-256 hash digestd of the specified file.
+    A tuple of SHA-256 hash digest and BLAKE3 hash digest of the specified
+    file. BLAKE3 hash digest is None if blake3 module is not available.
   """
-  with open(path, 'rb') as f:
-    try:
+  if blake3 is None and hasattr(hashlib, 'file_digest'):
+    with open_for_hashing(path) as f:
       # hashlib.file_digest is available in Python 3.11+
-      return hashlib.file_digest(f, 'sha256').hexdigest()
-    except AttributeError:
-      # Fallback to f.read().
-      h = hashlib.sha256()
-      h.update(f.read())
-      return h.hexdigest()
+      return hashlib.file_digest(f, 'sha256').hexdigest(), None
+  hasher = ArchiveHasher()
+  hash_file(path, hasher)
+  return hasher.sha256_hexdigest(), hasher.blake3_hexdigest()
+
+
+def get_digests_all(
+    paths: list[pathlib.Path],
+) -> dict[pathlib.Path, tuple[str, Union[str, None]]]:
+  """Returns SHA-256 and BLAKE3 hash digests of the specified files.
+
+  Multiple files are hashed in parallel with a process pool.
+
+  Args:
+    paths: Local paths of the files to calculate hash digests about.
+  Returns:
+    A dict from each path to the hash digests of the file. See get_digests.
+  """
+  if len(paths) <= 1:
+    return {path: get_digests(path) for path in paths}
+  with concurrent.futures.ProcessPoolExecutor(
+      max_workers=min(len(paths), os.cpu_count() or 1)
+  ) as executor:
+    return dict(zip(paths, executor.map(get_digests, paths)))
+
+
+def get_blake3(path: pathlib.Path) -> str:
+  """Returns BLAKE3 hash digest of the specified file.
+
+  Args:
+    path: Local path the file to calculate BLAKE3 about.
+  Returns:
+    BLAKE3 hash digest of the specified file.
+  """
+  h = blake3.blake3(max_threads=blake3.blake3.AUTO)
+  hash_file(path, h)
+  return h.hexdigest()
+
+
+def get_stamp_path(path: pathlib.Path) -> pathlib.Path:
+  """Returns the path of the verification stamp for the specified file."""
+  return path.with_suffix(path.suffix + '.verified')
+
+
+def read_sha256_stamp(
+    path: pathlib.Path, refresh: bool = True
+) -> Union[str, None]:
+  """Returns SHA-256 recorded in the verification stamp of the specified file.
+
+  The stamp is trusted when the file size and the modification time of the
+  specified file still match the ones recorded in the stamp. If only the
+  modification time differs, the file content is re-verified with the BLAKE3
+  digest recorded in the stamp, if any.
+
+  Args:
+    path: Local path of the file to look up the stamp for.
+    refresh: True to record the current modification time in the stamp after
+      it is re-verified with BLAKE3.
+  Returns:
+    SHA-256 hash digest recorded in the stamp, or None if the stamp is missing
+    or stale.
+  """
+  try:
+    sha256, size, mtime_ns, *blake3_digest = (
+        get_stamp_path(path).read_text().split()
+    )
+    size, mtime_ns = int(size), int(mtime_ns)
+    st = path.stat()
+  except (OSError, ValueError):
+    return None
+  if size != st.st_size:
+    return None
+  if mtime_ns == st.st_mtime_ns:
+    return sha256
+  if blake3 is None or not blake3_digest:
+    return None
+  if blake3_digest[0] != get_blake3(path):
+    return None
+  if refresh:
+    write_sha256_stamp(path, sha256, blake3_digest[0])
+  return sha256
+
+
+def write_sha256_stamp(
+    path: pathlib.Path, sha256: str, blake3_digest: Union[str, None] = None
+) -> None:
+  """Atomically writes the verification stamp for the specified file.
+
+  Args:
+    path: Local path of the verified file.
+    sha256: SHA-256 hash digest of the verified file.
+    blake3_digest: BLAKE3 hash digest of the verified file, if available.
+  """
+  st = path.stat()
+  line = f'{sha256} {st.st_size} {st.st_mtime_ns}'
+  if blake3_digest is not None:
+    line += f' {blake3_digest}'
+  stamp = get_stamp_path(path)
+  tmp = stamp.with_suffix(stamp.suffix + '.tmp')
+  tmp.write_text(line + '\n')
+  os.replace(tmp, stamp)
+
+
+class HashingWriter(io.RawIOBase):
+  """A raw stream that writes bytes into a file while hashing them.
+
+  Wrapping the destination file guarantees that the integrity check is done in
+  the same pass as the write, without reading the file back.
+
+  Attributes:
+    size: The total size of the file written so far.
+  """
+
+  def __init__(self, file: BinaryIO, hasher: Any, size: int = 0):
+    """Initializes the writer.
+
+    Args:
+      file: Unbuffered binary file to write bytes into. Closed with the writer.
+      hasher: Hash object to be updated with the written bytes.
+      size: The size of the file that already exists, if any.
+    """
+    super().__init__()
+    self.file = file
+    self.hasher = hasher
+    self.size = size
+
+  def writable(self) -> bool:
+    return True
+
+  def write(self, b) -> int:
+    n = self.file.write(b)
+    if n:
+      self.hasher.update(memoryview(b)[:n])
+      self.size += n
+    return n
+
+  def close(self) -> None:
+    if not self.closed:
+      self.file.close()
+    super().close()
+
+
+def verify_cache(
+    archives: list[ArchiveInfo], dryrun: bool = False
+) -> list[ArchiveInfo]:
+  """Verify cached archives and remove corrupted ones.
+
+  Args:
+    archives: ArchiveInfo list to be verified.
+    dryrun: True if this is a dry-run.
+  Returns:
+    ArchiveInfo list that still needs to be downloaded.
+  """
+  verified = set()
+  unstamped = {}
+  corrupted = {}
+  for archive in archives:
+    path = archive.cache_path
+    if not path.exists():
+      continue
+    size = path.stat().st_size
+    if size != archive.size:
+      # No need to calculate SHA-256 to know that this is corrupted.
+      corrupted[path] = (
+          f'{archive.filename} size mismatch.'
+          f' expected={archive.size} actual={size}'
+      )
+      continue
+    sha256 = read_sha256_stamp(path, refresh=not dryrun)
+    if sha256 is None:
+      unstamped[path] = archive
+    elif sha256 == archive.sha256:
+      verified.add(archive)
+    else:
+      corrupted[path] = (
+          f'{archive.filename} sha256 mismatch.'
+          f' expected={archive.sha256} actual={sha256}'
+      )
+
+  for path, (sha256, blake3_digest) in get_digests_all(
+      list(unstamped)
+  ).items():
+    archive = unstamped[path]
+    if sha256 == archive.sha256:
+      verified.add(archive)
+      if not dryrun:
+        write_sha256_stamp(path, sha256, blake3_digest)
+    else:
+      corrupted[path] = (
+          f'{archive.filename} sha256 mismatch.'
+          f' expected={archive.sha256} actual={sha256}'
+      )
+
+  for path, reason in corrupted.items():
+    if dryrun:
+      print(f'dryrun: Verification failed. {reason} removing {path}')
+    else:
+      print(f'{reason} removing {path}')
+      path.unlink()
+      get_stamp_path(path).unlink(missing_ok=True)
+  return [archive for archive in archives if archive not in verified]
 
 
-def download(archive: ArchiveInfo, dryrun: bool = False) -> None:
+def download(
+    archive: ArchiveInfo, dryrun: bool = False, progress: bool = True
+) -> None:
   """Download the specified file.
 
+  The file is downloaded into a '.part' file next to the destination, which
+  is renamed only after it is verified. An existing '.part' file left by an
+  interrupted download is resumed.
+
   Args:
     archive: ArchiveInfo to be downloaded.
     dryrun: True if this is a dry-run.
+    progress: True to print the download progress to the console.
 
   Raises:
-    RuntimeError: When the downloaded file looks to be corrupted.
+    RuntimeError: When the download request failed or the downloaded file
+      looks to be corrupted.
   """
 
-  path = CACHE_DIR.joinpath(archive.filename)
-  if path.exists():
-    if (
-        path.stat().st_size == archive.size
-        and get_sha256(path) == archive.sha256
-    ):
-      # Cache hit.
-      return
-    else:
-      if dryrun:
-        print(f'dryrun: Verification failed. removing {path}')
-      else:
-        path.unlink()
+  path = archive.cache_path
+  part = path.with_suffix(path.suffix + '.part')
+  resumable = part.exists() and part.stat().st_size < archive.size
 
   if dryrun:
-    print(f'Download {archive.url} to {path}')
+    if resumable:
+      print(f'dryrun: Resume downloading {archive.url} to {part}')
+    else:
+      print(f'Download {archive.url} to {path}')
     return
 
   CACHE_DIR.mkdir(parents=True, exist_ok=True)
   saved = 0
-  hasher = hashlib.sha256()
-  with requests.get(archive.url, stream=True, timeout=TIMEOUT) as r:
-    with ProgressPrinter() as printer:
-      with open(path, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=8192):
+  hasher = ArchiveHasher()
+  headers = {}
+  if resumable:
+    # Seed the hasher with the already downloaded prefix.
+    saved = hash_file(part, hasher)
+    headers['Range'] = f'bytes={saved}-'
+  # Archives are already compressed, so there is nothing to gain from content
+  # decoding.
+  with get_pool().request(
+      'GET',
+      archive.url,
+      headers=headers,
+      preload_content=False,
+      decode_content=False,
+      timeout=TIMEOUT,
+  ) as r:
+    if resumable and r.status == 206:
+      content_range = r.headers.get('Content-Range', '')
+      if not content_range.startswith(f'bytes {saved}-'):
+        # The partial content does not continue the '.part' file.
+        part.unlink()
+        raise RuntimeError(
+            f'{archive.filename} unexpected Content-Range.'
+            f' expected=bytes {saved}- actual={content_range}'
+        )
+      mode = 'ab'
+    elif r.status == 200:
+      # The server does not support range requests. Start over.
+      mode = 'wb'
+      saved = 0
+      hasher = ArchiveHasher()
+    else:
+      raise RuntimeError(
+          f'Failed to download {archive.url}. HTTP status={r.status}'
+      )
+    # read1() (urllib3 2.x) returns as soon as some data is available, so that
+    # progress is reported even on a slow connection.
+    read = getattr(r, 'read1', r.read)
+    with ProgressPrinter(enabled=progress) as printer:
+      writer = HashingWriter(open(part, mode, buffering=0), hasher, size=saved)
+      with io.BufferedWriter(writer, buffer_size=WRITE_BUFFER_SIZE) as f:
+        received = saved
+        while chunk := read(CHUNK_SIZE):
           f.write(chunk)
-          hasher.update(chunk)
-          saved += len(chunk)
-          printer.print_line(f'{archive.filename}: {saved}/{archive.size}')
+          received += len(chunk)
+          printer.print_line(f'{archive.filename}: {received}/{archive.size}')
+      saved = writer.size
   if saved != archive.size:
+    if saved > archive.size:
+      part.unlink()
+    # Otherwise keep the '.part' file so that the next run can resume it. It
+    # only contains bytes of a 200 response or a 206 response continuing it.
     raise RuntimeError(
         f'{archive.filename} size mismatch.'
         f' expected={archive.size} actual={saved}'
     )
-  actual_sha256 = hasher.hexdigest()
+  actual_sha256 = hasher.sha256_hexdigest()
   if actual_sha256 != archive.sha256:
+    part.unlink()
     raise RuntimeError(
         f'{archive.filename} sha256 mismatch.'
         f' expected={archive.sha256} actual={actual_sha256}'
     )
+  os.replace(part, path)
+  write_sha256_stamp(path, actual_sha256, hasher.blake3_hexdigest())
 
 
 class ProgressPrinter:
   """A utility to print progress message with carriage return and trancatoin."""
 
+  def __init__(self, enabled: bool = True):
+    self.enabled = enabled
+
   def __enter__(self):
-    if not sys.stdout.isatty():
+    if not self.enabled or not sys.stdout.isatty():
 
       class NoOpImpl:
-        """A no-op implementation in case stdout is not attached to concole."""
+        """A no-op implementation in case output is disabled.
+
+        Used when stdout is not attached to concole, or when progress output is
+        disabled, e.g. for concurrent downloads.
+        """
 
         def print_line(self, msg: str) -> None:
           """No-op implementation.
@@ -192,7 +568,22 @@ class ProgressPrinter:
 
     class Impl:
       """A real implementation in case stdout is attached to concole."""
-      last_output_time_ns = time.time_ns()
+      def __init__(self):
+        self.last_output_time_ns = time.monotonic_ns()
+        self.columns = os.get_terminal_size().columns
+        self.prev_sigwinch_handler = None
+        sigwinch = getattr(signal, 'SIGWINCH', None)
+        if (
+            sigwinch is not None
+            and threading.current_thread() is threading.main_thread()
+        ):
+          # Refresh the cached terminal width only when it is resized.
+          self.prev_sigwinch_handler = signal.signal(
+              sigwinch, self.on_resize
+          )
+
+      def on_resize(self, *unused_args) -> None:
+        self.columns = os.get_terminal_size().columns
 
       def print_line(self, msg: str) -> None:
         """Print the given message with carriage return and trancatoin.
@@ -200,30 +591,53 @@ class ProgressPrinter:
         Args:
           msg: Message to be printed.
         """
-        colmuns = os.get_terminal_size().columns
-        now = time.time_ns()
+        now = time.monotonic_ns()
         if (now - self.last_output_time_ns) < 25000000:
           return
+        colmuns = self.columns
         msg = msg + ' ' * max(colmuns - len(msg), 0)
         msg = msg[0 : (colmuns)] + '\r'
         sys.stdout.write(msg)
         sys.stdout.flush()
         self.last_output_time_ns = now
 
-    class Cleaner:
       def cleanup(self) -> None:
-        colmuns = os.get_terminal_size().columns
-        sys.stdout.write(' ' * colmuns + '\r')
+        if self.prev_sigwinch_handler is not None:
+          signal.signal(signal.SIGWINCH, self.prev_sigwinch_handler)
+        sys.stdout.write(' ' * self.columns + '\r')
         sys.stdout.flush()
 
-    self.cleaner = Cleaner()
-    return Impl()
+    impl = Impl()
+    self.cleaner = impl
+    return impl
 
   def __exit__(self, *exc):
     if self.cleaner:
       self.cleaner.cleanup()
 
 
+def write_file(path: pathlib.Path, data: bytes) -> None:
+  """Write the given data into the file with a single write and fsync.
+
+  Args:
+    path: Local path of the file to be written.
+    data: The whole content of the file.
+  """
+  fd = os.open(
+      path,
+      os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0),
+      0o666,
+  )
+  try:
+    view = memoryview(data)
+    while view:
+      # os.write() may write only a part of the data.
+      view = view[os.write(fd, view) :]
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+
+
 def extract_ninja(dryrun: bool = False) -> None:
   """Extract ninja-win archive.
 
@@ -239,7 +653,7 @@ def extract_ninja(dryrun: bool = False) -> None:
     exe = 'ninja.exe'
   else:
     return
-  src = CACHE_DIR.joinpath(archive.filename)
+  src = archive.cache_path
 
   if dryrun:
     if dest.exists():
@@ -247,35 +661,57 @@ def extract_ninja(dryrun: bool = False) -> None:
     print(f'dryrun: Extracting {exe} from {src} into {dest}')
     return
 
+  dest.mkdir(parents=True, exist_ok=True)
+  ninja = dest.joinpath(exe)
   with zipfile.ZipFile(src) as z:
-    z.extract(exe, path=dest)
+    if z.getinfo(exe).file_size <= MAX_IN_MEMORY_EXTRACT_SIZE:
+      write_file(ninja, z.read(exe))
+    else:
+      with z.open(exe) as src_file, open(
+          ninja, 'wb', buffering=CHUNK_SIZE
+      ) as dest_file:
+        shutil.copyfileobj(src_file, dest_file, CHUNK_SIZE)
 
   if is_mac():
-    ninja = dest.joinpath(exe)
     ninja.chmod(ninja.stat().st_mode | stat.S_IXUSR)
 
 
+@functools.cache
 def is_windows() -> bool:
   """Returns true if the platform is Windows."""
   return os.name == 'nt'
 
 
+@functools.cache
 def is_mac() -> bool:
   """Returns true if the platform is Mac."""
   return os.name == 'posix' and os.uname()[0] == 'Darwin'
 
 
-def update_submodules(dryrun: bool = False) -> None:
+def update_submodules(dryrun: bool = False, shallow: bool = True) -> None:
   """Run 'git submodule update --init --recursive'.
 
+  Submodules are fetched in parallel.
+
   Args:
     dryrun: true to perform dryrun.
+    shallow: true to fetch only the checked out commit of each submodule.
   """
-  command = ' '.join(['git', 'submodule', 'update', '--init', '--recursive'])
+  args = [
+      'git',
+      'submodule',
+      'update',
+      '--init',
+      '--recursive',
+      '--jobs',
+      str(os.cpu_count() or 4),
+  ]
+  if shallow:
+    args += ['--depth', '1']
   if dryrun:
-    print(f'dryrun: subprocess.run({command}, shell=True, check=True)')
+    print(f'dryrun: subprocess.run({args}, check=True)')
   else:
-    subprocess.run(command, shell=True, check=True)
+    subprocess.run(args, check=True)
 
 
 def exec_command(args: list[str], cwd: os.PathLike[str]) -> None:
@@ -315,6 +751,9 @@ def main():
   parser.add_argument('--noqt', action='store_true', default=False)
   parser.add_argument('--nowix', action='store_true', default=False)
   parser.add_argument('--nosubmodules', action='store_true', default=False)
+  parser.add_argument(
+      '--submodules_full_history', action='store_true', default=False
+  )
   parser.add_argument('--cache_only', action='store_true', default=False)
 
   args = parser.parse_args()
@@ -328,8 +767,22 @@ def main():
     elif is_windows():
       archives.append(NINJA_WIN)
 
-  for archive in archives:
-    download(archive, args.dryrun)
+  missing_archives = verify_cache(archives, args.dryrun)
+  if len(missing_archives) > 1:
+    # Download archives concurrently. Progress lines are suppressed because
+    # carriage-return based output from multiple threads would interleave.
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=len(missing_archives)
+    ) as executor:
+      futures = [
+          executor.submit(download, archive, args.dryrun, progress=False)
+          for archive in missing_archives
+      ]
+      for future in futures:
+        future.result()
+  else:
+    for archive in missing_archives:
+      download(archive, args.dryrun)
 
   if args.cache_only:
     return
@@ -341,7 +794,9 @@ def main():
     extract_ninja(args.dryrun)
 
   if not args.nosubmodules:
-    update_submodules(args.dryrun)
+    update_submodules(
+        args.dryrun, shallow=not args.submodules_full_history
+    )
 
 
 if __name__ == '__main__':